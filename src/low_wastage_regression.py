@@ -21,7 +21,10 @@ class LowWastageRegression:
 	""" If the multiplier for failed attempts is optimized, limit it to this value, e.g., increase allocation by at least 50% upon each failure."""
 	min_base = 1.5
 
-	def __init__(self, training_data: pd.DataFrame, predictor_column: str, resource_column: str, run_time_column: str, relative_time_to_failure: float, min_allocation: float):
+	""" Number of models in the bootstrap ensemble. Each model is trained on a random sample of 70% of the training data."""
+	ensemble_size = 10
+
+	def __init__(self, training_data: pd.DataFrame, predictor_column: str, resource_column: str, run_time_column: str, relative_time_to_failure: float, min_allocation: float, batched: bool = False):
 
 		self.min_allocation = min_allocation
 		self.relative_time_to_failure = relative_time_to_failure
@@ -50,7 +53,11 @@ class LowWastageRegression:
 		# train model
 		self.models = []
 
-		for i in range(10):
+		if batched and self.__predictor_varies_enough__():
+			self.models = self.__train_batched__(optimize_base=False)
+			return
+
+		for i in range(self.ensemble_size):
 			self.training_data = self.data.sample(frac=0.7, random_state=i)
 			self.models.append(self.__train__(optimize_base=False))
 			print(self.models[-1][0].slope)
@@ -121,8 +128,71 @@ class LowWastageRegression:
 		else:
 			return self.__train_linear__(optimize_base=optimize_base)
 
-	def __train_quantile__(self):
-		pass
+	def __train_quantile__(self, base: float = 2):
+		"""
+		Compute the wastage-minimizing constant first allocation, used when the predictor does not vary enough to fit a slope.
+		For a constant allocation a, job i fails k_i = max(0, ceil(log_base(rss_i / a))) times and wastes
+		run_time_i * (a * base^k_i - rss_i + a * (base^k_i - 1) / (base - 1) * relative_time_to_failure).
+		While k_i is fixed, this increases with a. k_i drops by one whenever a reaches rss_i / base^j, so the optimum is either the minimum allocation or one of these breakpoints.
+		A single sweep over the sorted breakpoints updates the sum of run_time_i * base^k_i with prefix sums, which gives the exact optimum in O(m log m) for m breakpoints.
+		If the minimum allocation is not positive, the breakpoints are bounded from below as follows. Below the smallest positive rss, dividing a by base keeps a * base^k_i of all jobs with positive rss
+		and changes the wastage by a * (1 - 1/base) * (run time of jobs with zero rss - relative_time_to_failure / (base - 1) * run time of jobs with positive rss).
+		If this change is not negative, the optimum is at least the smallest positive rss / base. Otherwise, e.g., for relative_time_to_failure = 0,
+		the wastage keeps decreasing towards zero allocation and has no minimum. The search then stops where the remaining improvement is below 1e-9 of the usage.
+		:param base: The multiplier to apply to the resource allocation of a failed attempt.
+		:return: the model (slope 0) and its wastage on the training data
+		"""
+		resource = self.training_data[self.resource_column].to_numpy(dtype=float)
+		run_time = self.training_data[self.run_time_column].to_numpy(dtype=float)
+
+		ttf_factor = self.relative_time_to_failure / (base - 1)
+
+		# allocations must be positive, otherwise the number of failures is unbounded
+		positive = resource > 0
+		if not positive.any() and self.min_allocation <= 0:
+			# all jobs use the minimum resource amount, which is zero after normalization, so allocating it wastes nothing
+			model = self.__linear_model__(slope=0, intercept=0, base=base)
+			self.training_data['first_allocation'] = model.apply(self.training_data)
+			return model, Wastage(usage=0, oversizing=0, undersizing=0, failures=0)
+
+		if self.min_allocation > 0:
+			lowest = self.min_allocation
+		elif positive.any():
+			lowest = resource[positive].min() / base
+			# how much the wastage decreases when dividing an allocation below the smallest positive rss by base, per unit of allocation * (1 - 1/base)
+			decrease = run_time[~positive].sum() - ttf_factor * run_time[positive].sum()
+			if decrease > 0:
+				# the improvement from any allocation below lowest is at most lowest * base * decrease
+				lowest = min(lowest, 1e-9 * np.sum(run_time * resource) / (base * decrease))
+
+		# breakpoints rss_i / base^j above the lowest allocation, each with the change in run_time_i * base^k_i when a reaches it
+		resource_above = resource[resource > lowest]
+		run_time_above = run_time[resource > lowest]
+		levels = np.ceil(np.log(resource_above / lowest) / np.log(base)).astype(int)
+		job = np.repeat(np.arange(len(resource_above)), levels)
+		j = np.arange(len(job)) - np.repeat(np.cumsum(levels) - levels, levels)
+
+		breakpoints = resource_above[job] / base ** j
+		changes = -run_time_above[job] * base ** j * (base - 1)
+		order = np.argsort(breakpoints, kind='stable')
+
+		with np.errstate(divide='ignore'):
+			failures_lowest = np.clip(np.ceil(np.log(resource / lowest) / np.log(base)), a_min=0, a_max=None)
+
+		allocations = np.concatenate([[lowest], breakpoints[order]])
+		weighted_attempts = np.sum(run_time * base ** failures_lowest) + np.concatenate([[0], np.cumsum(changes[order])])
+		wastages = allocations * ((1 + ttf_factor) * weighted_attempts - ttf_factor * run_time.sum()) - np.sum(run_time * resource)
+
+		# allocate slightly more than a breakpoint, such that rounding errors in the logarithm do not count a spurious failure
+		best = np.argmin(wastages)
+		intercept = allocations[best] * (1 + 1e-9) if best > 0 else lowest
+
+		model = self.__linear_model__(slope=0, intercept=intercept, base=base)
+		self.training_data['first_allocation'] = model.apply(self.training_data)
+		wastage = Wastage.exponential(self.training_data, relative_ttf=self.relative_time_to_failure, resource_column=self.resource_column,
+									  first_allocation_column='first_allocation', run_time_column=self.run_time_column, base=base)
+
+		return model, wastage
 
 	def __train_linear__(self, optimize_base: bool = False, max_iter_cobyla=200):
 		"""
@@ -192,6 +262,141 @@ class LowWastageRegression:
 
 		return best_parameters, lowest_wastage
 
+	def __train_batched__(self, optimize_base: bool = False, max_iter: int = 200, initial_step: float = 0.1, min_step: float = 1e-4, coarse_step: float = 3e-3, chunk_size: int = 4096):
+		"""
+		Train all ensemble members at once. Each member holds the row positions of its bootstrap sample of the shared training data,
+		and each step evaluates the candidate parameters of all unconverged searches (see __candidate_wastage__).
+		Each search is a compass search: in each step, try moving the slope, intercept, and optionally, base by +/- the search's step size,
+		take the best improving move, or halve the step size if no move improves. The wastage is piecewise smooth, so this derivative-free method suits the 2-3 parameters well.
+		Each member runs one search from each initial solution and keeps the search with the lowest wastage.
+		Instead of a weight matrix over all jobs with one objective call for all members, candidates are evaluated member by member on the member's own rows:
+		the weight matrix approach evaluates every job for every member and candidate, including the 30% of jobs outside each member's sample,
+		and its intermediate arrays grow with members * candidates * jobs, which exhausts memory on large traces. The per-member loop costs only a few Python calls per step.
+		Searches pause once their step size falls below coarse_step, unless they are currently the best search of their member, so only the most promising search of each member is refined down to min_step.
+		:param optimize_base: optimize the base as third parameter, constrained to be at least min_base
+		:param max_iter: maximum number of compass search steps
+		:param initial_step: initial step size in the normalized parameter space
+		:param min_step: a search stops when its step size falls below this value
+		:param coarse_step: step size below which only the best search of each member continues
+		:param chunk_size: number of jobs per chunk when evaluating candidates, bounds the size of the scratch buffers
+		:return: a list of (model, wastage) pairs, one per ensemble member. Unlike building models one by one with __train__, the models are optimized with a compass search instead of COBYLA,
+			the initial solutions are computed once on the entire training data instead of on each member's sample, and the best search is the one with the lowest wastage instead of the highest MAQ.
+		"""
+
+		# use the same samples as the unbatched training
+		positions = pd.Series(np.arange(len(self.data)))
+		samples = [positions.sample(frac=0.7, random_state=i).to_numpy() for i in range(self.ensemble_size)]
+		columns = [self.data[column].to_numpy(dtype=float) for column in [self.predictor_column, self.resource_column, self.run_time_column]]
+		sample_columns = [[column[sample] for column in columns] for sample in samples]
+
+		# compute initial slopes and intercepts
+		self.training_data = self.data
+		initial_parameterss = self.__quantile_regression__()
+
+		iqr_predictor = sps.iqr(self.data[self.predictor_column])
+		iqr_resource = sps.iqr(self.data[self.resource_column])
+		slope = iqr_resource / iqr_predictor if iqr_predictor > 0 else 0
+		intercept = self.data[self.resource_column].mean() - slope * self.data[self.predictor_column].mean()
+		initial_parameterss.append(self.__linear_model__(slope, intercept, base=2))
+
+		dimensions = 3 if optimize_base else 2
+		initial = np.array([[p.slope, p.intercept, 2][:dimensions] for p in initial_parameterss])
+		directions = np.concatenate([np.eye(dimensions), -np.eye(dimensions)])
+
+		# run one search per member and initial solution, the same as __train_linear__ runs COBYLA once per initial solution
+		member = np.repeat(np.arange(self.ensemble_size), len(initial))
+		parameters = np.tile(initial, (self.ensemble_size, 1))
+		step = np.full(len(parameters), initial_step)
+
+		buffers = np.empty((3, len(initial) * len(directions), chunk_size))
+		lowest_wastage = np.empty(len(parameters))
+		for i in range(self.ensemble_size):
+			lowest_wastage[member == i] = self.__candidate_wastage__(parameters[member == i], *sample_columns[i], buffers)
+
+		for _ in range(max_iter):
+			# refine only the best search of each member below the coarse step size
+			member_lowest = np.minimum.reduceat(lowest_wastage, np.arange(0, len(lowest_wastage), len(initial)))
+			active = np.flatnonzero((step >= min_step) & ((step >= coarse_step) | (lowest_wastage == member_lowest[member])))
+			if len(active) == 0:
+				break
+
+			# shape (searches, directions, dimensions)
+			candidates = parameters[active, None, :] + step[active, None, None] * directions
+			if optimize_base:
+				candidates[..., 2] = np.maximum(candidates[..., 2], self.min_base)
+
+			wastages = np.empty(candidates.shape[:2])
+			for i in np.unique(member[active]):
+				searches = member[active] == i
+				wastages[searches] = self.__candidate_wastage__(candidates[searches].reshape(-1, dimensions), *sample_columns[i], buffers).reshape(-1, len(directions))
+
+			best = np.argmin(wastages, axis=1)
+			best_wastage = wastages[np.arange(len(active)), best]
+
+			improved = best_wastage < lowest_wastage[active]
+			parameters[active[improved]] = candidates[improved, best[improved]]
+			lowest_wastage[active[improved]] = best_wastage[improved]
+			step[active[~improved]] /= 2
+
+		# keep the best search of each member
+		parameters = parameters.reshape(self.ensemble_size, len(initial), dimensions)[np.arange(self.ensemble_size), np.argmin(lowest_wastage.reshape(self.ensemble_size, -1), axis=1)]
+
+		models = []
+		for i in range(self.ensemble_size):
+			model = self.__linear_model__(slope=parameters[i, 0], intercept=parameters[i, 1], base=parameters[i, 2] if optimize_base else 2)
+			self.training_data = self.data.iloc[samples[i]].copy()
+			self.training_data['first_allocation'] = model.apply(self.training_data)
+			models.append((model, Wastage.exponential(self.training_data, relative_ttf=self.relative_time_to_failure, resource_column=self.resource_column,
+													  first_allocation_column='first_allocation', run_time_column=self.run_time_column, base=model.base)))
+
+		return models
+
+	def __candidate_wastage__(self, parameters: np.ndarray, predictor: np.ndarray, resource: np.ndarray, run_time: np.ndarray, buffers: np.ndarray) -> np.ndarray:
+		"""
+		Vectorized version of the objective in __train_linear__ for several candidate parameters on the same sample.
+		The jobs are processed in chunks that fit into the preallocated buffers, such that memory usage does not grow with the number of jobs.
+		:param parameters: shape (candidates, 2 or 3) containing slope, intercept, and optionally, base
+		:param predictor: the predictor values of the jobs in the sample
+		:param resource: the resource usage of the jobs in the sample
+		:param run_time: the execution duration of the jobs in the sample
+		:param buffers: shape (3, at least candidates, chunk size) scratch space
+		:return: shape (candidates) containing the over- plus undersizing wastage of each candidate, or infinity if it is not finite
+		"""
+		slope, intercept = parameters[:, 0:1], parameters[:, 1:2]
+		base = parameters[:, 2:3] if parameters.shape[1] == 3 else 2
+
+		# the wastage of a job is run_time * (allocation * (base^k * (1 + ttf_factor) - ttf_factor) - resource)
+		ttf_factor = self.relative_time_to_failure / (base - 1)
+		log_base = np.log(base)
+
+		wastage = np.full(len(parameters), -np.dot(resource, run_time))
+		for start in range(0, len(predictor), buffers.shape[2]):
+			stop = min(start + buffers.shape[2], len(predictor))
+			allocation, power, tmp = buffers[:, :len(parameters), :stop - start]
+
+			np.multiply(predictor[start:stop], slope, out=allocation)
+			np.add(allocation, intercept, out=allocation)
+			np.maximum(allocation, self.min_allocation, out=allocation)
+
+			np.divide(resource[start:stop], allocation, out=power)
+			np.log(power, out=power)
+			np.divide(power, log_base, out=power)
+			np.ceil(power, out=power)
+			np.maximum(power, 0, out=power)
+			# base^k, exp is much faster than power
+			np.multiply(power, log_base, out=power)
+			np.exp(power, out=power)
+
+			np.multiply(power, 1 + ttf_factor, out=tmp)
+			np.subtract(tmp, ttf_factor, out=tmp)
+			np.multiply(tmp, allocation, out=tmp)
+			wastage += tmp @ run_time[start:stop]
+
+		# allocating nothing to a job gives 0 * inf = NaN, such candidates must never be selected
+		wastage[~np.isfinite(wastage)] = np.inf
+
+		return wastage
+
 	def __linear_model__(self, slope, intercept, base):
 		return LinearModel(slope=slope, intercept=intercept, base=base, predictor_column=self.predictor_column, min_allocation=self.min_allocation)
 
@@ -2,6 +2,7 @@
 	
 """
 from unittest import TestCase
+import numpy as np
 import pandas as pd
 
 from low_wastage_regression import LowWastageRegression
@@ -44,6 +45,93 @@ class TestLowWastageRegression(TestCase):
 		print(lwr.quality)
 		self.assertAlmostEqual(lwr.quality.maq, 1, 2)
 
+	def test_constant_predictor(self):
+
+		rng = np.random.default_rng(0)
+		data = pd.DataFrame(dict(rss=rng.lognormal(0, 1, 50), run_time=rng.uniform(1, 10, 50), input_size=5))
+
+		lwr = LowWastageRegression(data, 'input_size', 'rss', 'run_time', 0.5, 0.01)
+		self.assertEqual(lwr.model.slope, 0)
+		self.assertEqual(len(set(lwr.predict(data))), 1)
+
+		# without variation in rss, the normalized rss is zero and allocating it is perfect
+		data_constant = pd.DataFrame(dict(rss=[7, 7, 7], run_time=1, input_size=0))
+		for min_allocation in [0, -1]:
+			lwr = LowWastageRegression(data_constant, 'input_size', 'rss', 'run_time', 0.5, min_allocation)
+			self.assertEqual(lwr.quality.maq, 1)
+			self.assertListEqual(list(lwr.predict(data_constant)), [7, 7, 7])
+
+		# compare to a dense grid of allocations, also without minimum allocation and with free failures
+		for relative_time_to_failure, min_allocation, base in [(0.5, 0.01, 2), (0.5, 0, 2), (0, 0, 2), (1.5, 0, 1.5), (0.1, 0.2, 3)]:
+			lwr = LowWastageRegression(data, 'input_size', 'rss', 'run_time', relative_time_to_failure, min_allocation)
+			lwr.training_data = lwr.data.copy()
+			model, wastage = lwr.__train_quantile__(base=base)
+
+			resource = lwr.data['rss'].to_numpy()
+			run_time = lwr.data['run_time'].to_numpy()
+			allocation = np.geomspace(max(min_allocation, 1e-6), 2, 50000)[:, None]
+			with np.errstate(divide='ignore'):
+				k = np.clip(np.ceil(np.log(resource / allocation) / np.log(base)), a_min=0, a_max=None)
+			grid_wastage = np.sum((allocation * base ** k - resource + allocation * (base ** k - 1) / (base - 1) * relative_time_to_failure) * run_time, axis=1)
+
+			self.assertLessEqual(wastage.oversizing + wastage.undersizing, grid_wastage.min() + 1e-6 * wastage.usage)
+
+	def test_batched(self):
+
+		rng = np.random.default_rng(0)
+		input_size = rng.uniform(1, 10, 500)
+		data = pd.DataFrame(dict(rss=2 * input_size + rng.uniform(0, 3, 500), run_time=rng.uniform(1, 10, 500), input_size=input_size))
+
+		lwr = LowWastageRegression(data, 'input_size', 'rss', 'run_time', 0.5, 0.01)
+		batched = LowWastageRegression(data, 'input_size', 'rss', 'run_time', 0.5, 0.01, batched=True)
+
+		self.assertEqual(len(batched.models), LowWastageRegression.ensemble_size)
+		self.assertGreater(batched.quality.maq, lwr.quality.maq - 0.01)
+		self.assertEqual(len(batched.predict(data)), len(data))
+
+		# candidates that allocate nothing to some jobs have no finite wastage and must not be selected
+		group = rng.integers(0, 2, 500)
+		data = pd.DataFrame(dict(rss=np.where(group, 3 * input_size + 1, 0.5 * input_size) + rng.uniform(0, 1, 500), run_time=rng.uniform(1, 10, 500), input_size=input_size))
+		batched = LowWastageRegression(data, 'input_size', 'rss', 'run_time', 0.5, 0, batched=True)
+
+		for model, quality in batched.models:
+			self.assertTrue(np.isfinite(quality.maq))
+			self.assertTrue(np.all(model.apply(batched.data) > 0))
+
+	def test_batched_speed(self):
+		"""
+		Compare the time to train the entire ensemble in batched mode to training a single member one by one.
+		Batched training should not hold the wastage of all jobs for all members and candidates at once.
+		"""
+		import time
+		import tracemalloc
+
+		rng = np.random.default_rng(0)
+		input_size = rng.uniform(1, 10, 20000)
+		data = pd.DataFrame(dict(rss=2 * input_size + rng.uniform(0, 3, 20000), run_time=rng.uniform(1, 10, 20000), input_size=input_size))
+		lwr = LowWastageRegression(data, 'input_size', 'rss', 'run_time', 0.5, 0.01, batched=True)
+
+		before = time.time()
+		lwr.__train_batched__()
+		batched_time = time.time() - before
+
+		lwr.training_data = lwr.data.sample(frac=0.7, random_state=0)
+		before = time.time()
+		lwr.__train__(optimize_base=False)
+		single_member_time = time.time() - before
+
+		print("Batched ensemble: {} sec, single member: {} sec".format(batched_time, single_member_time))
+
+		# less than a single array with the wastage of every job for every member and candidate
+		tracemalloc.start()
+		lwr.__train_batched__()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		lwr.training_data = lwr.data
+		initial_solutions = len(lwr.__quantile_regression__()) + 1
+		directions = 2 * 2
+		self.assertLess(peak, LowWastageRegression.ensemble_size * initial_solutions * directions * len(data) * 8)
+
 	def test_train_evaluation(self):
 		"""
 		TODO test that wastage (MAQ/failures,etc.) are identical when training on a data set and then obtaining predictions on that data set.
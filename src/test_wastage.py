@@ -3,8 +3,10 @@ from functools import partial
 
 import pandas as pd
 
+import numpy as np
+
 from wastage import Wastage, wastage_exponential_prop_ttf, wastage_simple, oversizing_wastage_exponential, \
-	undersizing_wastage_exponential, wastage_exponential
+	undersizing_wastage_exponential, wastage_exponential, wastage_3step
 
 
 def wastage_exponential_naive(df: pd.DataFrame, relative_ttf: float, base: float) -> Wastage:
@@ -130,3 +132,41 @@ class TestWastage(unittest.TestCase):
 		self.assertEqual(w.usage, 50)
 		self.assertEqual(w.oversizing, 30)
 		self.assertEqual(w.undersizing, 42.5)
+
+	def test_sharded(self):
+		"""
+		Make sure the parallel evaluation mode returns the same results as the vectorized implementation and
+		that its results are bit-for-bit identical for any number of workers.
+		"""
+		rng = np.random.default_rng(0)
+		df = pd.DataFrame(dict(
+			rss=rng.uniform(0.1, 10, 10001),
+			run_time=rng.uniform(1, 100, 10001),
+			first_allocation=rng.uniform(0.5, 8, 10001),
+		))
+
+		for wastage_func in [
+			partial(Wastage.exponential, relative_ttf=0.5, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time', base=2),
+			partial(wastage_exponential, relative_ttf=0.5, base=1.5),
+			partial(wastage_exponential_prop_ttf, base=2),
+			partial(wastage_3step, max_seen_so_far=9, max_available=10, relative_ttf=0.5),
+		]:
+			vectorized = wastage_func(df)
+			sharded = [wastage_func(df, workers=workers, shard_size=512) for workers in [1, 2, 3, 8]]
+
+			for w in sharded:
+				self.assertEqual(w.failures, vectorized.failures)
+				self.assertAlmostEqual(w.oversizing / vectorized.oversizing, 1, 10)
+				self.assertAlmostEqual(w.undersizing / vectorized.undersizing, 1, 10)
+				self.assertAlmostEqual(w.usage / vectorized.usage, 1, 10)
+
+				self.assertEqual(w.oversizing, sharded[0].oversizing)
+				self.assertEqual(w.undersizing, sharded[0].undersizing)
+				self.assertEqual(w.usage, sharded[0].usage)
+
+			# the kernels and arrays are pickled to worker processes
+			w = wastage_func(df, workers=2, shard_size=512, processes=True)
+			self.assertEqual(w.oversizing, sharded[0].oversizing)
+			self.assertEqual(w.undersizing, sharded[0].undersizing)
+			self.assertEqual(w.usage, sharded[0].usage)
+			self.assertEqual(w.failures, sharded[0].failures)
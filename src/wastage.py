@@ -5,7 +5,9 @@
 """
 import math
 from collections import namedtuple
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional, Tuple
 
 import pandas as pd
 import numpy as np
@@ -13,6 +15,9 @@ import numpy as np
 __author__ = 'Carl Witt'
 __email__ = 'wittcarx@informatik.hu-berlin.de'
 
+""" Number of jobs per shard in the parallel evaluation mode. Each scratch buffer holds one shard (256 KiB of float64), small enough to stay in cache."""
+SHARD_SIZE = 1 << 15
+
 
 class ModelParameters:
 	def __init__(self, slope: float, intercept: float, base: Optional[float] = None, quadratic: Optional[float] = None):
@@ -35,7 +40,9 @@ class Wastage:
 
 	@property
 	def maq(self):
-		return self.usage / (self.usage + self.oversizing + self.undersizing)
+		total = self.usage + self.oversizing + self.undersizing
+		# nothing used and nothing wasted is a perfect allocation
+		return self.usage / total if total != 0 else 1
 
 	def __str__(self):
 		return("MAQ {:.2f}% oversizing {:.1f}% undersizing {:.1f}% failures {}\n".format(
@@ -45,7 +52,8 @@ class Wastage:
 			self.failures))
 
 	@staticmethod
-	def exponential(df: pd.DataFrame, relative_ttf: float, resource_column, first_allocation_column, run_time_column, base: float = 2) -> "Wastage":
+	def exponential(df: pd.DataFrame, relative_ttf: float, resource_column, first_allocation_column, run_time_column, base: float = 2,
+					workers: Optional[int] = None, shard_size: int = SHARD_SIZE, processes: bool = False) -> "Wastage":
 		"""
 		Compute the wastage under the assumption that allocated resources are multiplied by `base` after each failed attempt.
 		:param df: needs a column 'first_allocation_column' containing the allocated resources for the first attempt of a task
@@ -54,10 +62,17 @@ class Wastage:
 		:param resource_column: The name of the pandas dataframe column containing the resource usage values.
 		:param first_allocation_column: Column containing the amount of resources allocated to the first attempt of each job.
 		:param run_time_column: Column containing the execution duration of each job.
+		:param workers: If given, evaluate in parallel on this many workers (see sharded_wastage). The result does not depend on the number of workers.
+		:param shard_size: Number of jobs per shard in the parallel evaluation mode.
+		:param processes: Use a process pool instead of a thread pool in the parallel evaluation mode.
 		:return:
 		"""
 		assert len(df) > 0
 
+		if workers is not None:
+			kernel = partial(_exponential_kernel, relative_ttf=relative_ttf, base=base)
+			return sharded_wastage(df, kernel, resource_column, first_allocation_column, run_time_column, workers=workers, shard_size=shard_size, processes=processes)
+
 		k = np.clip(np.ceil(np.log(df[resource_column] / df[first_allocation_column]) / np.log(base)), a_min=0, a_max=None)
 
 		undersizing = df[first_allocation_column] * (base ** k - 1) / (base - 1) * df[run_time_column] * relative_ttf
@@ -139,7 +154,8 @@ def undersizing_wastage_2step(real_usage: float, abs_ttf: float, first_allocatio
 	return first_allocation * abs_ttf
 
 
-def wastage_3step(df: pd.DataFrame, max_seen_so_far: float, max_available: float, relative_ttf: float, eps: float = 1e-4, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time') -> Wastage:
+def wastage_3step(df: pd.DataFrame, max_seen_so_far: float, max_available: float, relative_ttf: float, eps: float = 1e-4, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time',
+				  workers: Optional[int] = None, shard_size: int = SHARD_SIZE, processes: bool = False) -> Wastage:
 	"""
 	Computes wastage with maximum failure handling strategy by summing up wastage for every job in a set
 	:param df: data frame containing the actual resource usage, execution duration, etc. of tasks
@@ -150,10 +166,17 @@ def wastage_3step(df: pd.DataFrame, max_seen_so_far: float, max_available: float
 	:param resource_column: the name of the column to read the actual resource usage from
 	:param first_allocation_column: column that contains the first allocation
 	:param run_time_column: column that contains the execution duration
+	:param workers: if given, evaluate in parallel on this many workers (see sharded_wastage)
+	:param shard_size: number of jobs per shard in the parallel evaluation mode
+	:param processes: use a process pool instead of a thread pool in the parallel evaluation mode
 	:return:
 	"""
 	assert len(df) > 0
 
+	if workers is not None:
+		kernel = partial(_3step_kernel, max_seen_so_far=max_seen_so_far, max_available=max_available, relative_ttf=relative_ttf, eps=eps)
+		return sharded_wastage(df, kernel, resource_column, first_allocation_column, run_time_column, workers=workers, shard_size=shard_size, processes=processes, mask=True)
+
 	success_on_first_attempt = df[resource_column] <= df[first_allocation_column] + eps
 	success_on_second_attempt = ~success_on_first_attempt & (df[resource_column] <= max_seen_so_far + eps)
 	success_on_third_attempt = ~success_on_first_attempt & ~success_on_second_attempt & (df[resource_column] <= max_available + eps)
@@ -197,16 +220,24 @@ def wastage_3step(df: pd.DataFrame, max_seen_so_far: float, max_available: float
 	return Wastage(oversizing=oversizing, undersizing=undersizing, usage=sum(df[run_time_column]*df[resource_column]), failures=int(failures))
 
 
-def wastage_exponential(df: pd.DataFrame, relative_ttf: float, base: float, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time') -> Wastage:
+def wastage_exponential(df: pd.DataFrame, relative_ttf: float, base: float, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time',
+						workers: Optional[int] = None, shard_size: int = SHARD_SIZE, processes: bool = False) -> Wastage:
 	"""
 	Compute the wastage under the assumption that after each failure another attempt is tried with base*previous allocation
 	:param df: needs a column 'first_allocation_column' containing the allocated memory for the first attempt of a task
 	:param relative_ttf:
 	:param base:
+	:param workers: if given, evaluate in parallel on this many workers (see sharded_wastage)
+	:param shard_size: number of jobs per shard in the parallel evaluation mode
+	:param processes: use a process pool instead of a thread pool in the parallel evaluation mode
 	:return:
 	"""
 	assert len(df) > 0
 
+	if workers is not None:
+		kernel = partial(_exponential_kernel, relative_ttf=relative_ttf, base=base)
+		return sharded_wastage(df, kernel, resource_column, first_allocation_column, run_time_column, workers=workers, shard_size=shard_size, processes=processes)
+
 	k = np.clip(np.ceil(np.log(df[resource_column] / df[first_allocation_column]) / np.log(base)), a_min=0, a_max=None)
 
 	undersizing = df[first_allocation_column] * (base ** k - 1) / (base - 1) * df[run_time_column] * relative_ttf
@@ -215,16 +246,24 @@ def wastage_exponential(df: pd.DataFrame, relative_ttf: float, base: float, reso
 	return Wastage(oversizing=oversizing.sum(), undersizing=undersizing.sum(), usage=sum(df[run_time_column]*df[resource_column]), failures=int(k.sum()))
 
 
-def wastage_exponential_prop_ttf(df: pd.DataFrame, base: float, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time') -> Wastage:
+def wastage_exponential_prop_ttf(df: pd.DataFrame, base: float, resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time',
+								 workers: Optional[int] = None, shard_size: int = SHARD_SIZE, processes: bool = False) -> Wastage:
 	"""
 	Like wastage_exponential, but assume that the time to failure is proportional to the prediction error.
 	E.g., when allocting 1 GB to a 10 GB task, time to failure is 1/10, whereas for 9 GB it's 0.9.
 	:param df: needs a column 'first_allocation_column' containing the allocated memory for the first attempt of a task
 	:param base:
+	:param workers: if given, evaluate in parallel on this many workers (see sharded_wastage)
+	:param shard_size: number of jobs per shard in the parallel evaluation mode
+	:param processes: use a process pool instead of a thread pool in the parallel evaluation mode
 	:return:
 	"""
 	assert len(df) > 0
 
+	if workers is not None:
+		kernel = partial(_exponential_prop_ttf_kernel, base=base)
+		return sharded_wastage(df, kernel, resource_column, first_allocation_column, run_time_column, workers=workers, shard_size=shard_size, processes=processes)
+
 	k = np.clip(np.ceil(np.log(df[resource_column] / df[first_allocation_column]) / np.log(base)), a_min=0, a_max=None)
 
 	undersizing = df[first_allocation_column]**2 / df[resource_column] * (base**(2*k) - 1) / (base**2 - 1) * df[run_time_column]
@@ -256,4 +295,173 @@ def wastage_simple(df: pd.DataFrame, resource_column='rss', first_allocation_col
 
 	usage = df[df[first_allocation_column] >= df[resource_column]][resource_column].sum()
 
-	return Wastage(usage = usage, oversizing=oversizing, undersizing=undersizing, failures=failures)
\ No newline at end of file
+	return Wastage(usage = usage, oversizing=oversizing, undersizing=undersizing, failures=failures)
+
+
+def sharded_wastage(df: pd.DataFrame, kernel: Callable[..., Tuple[float, float, float, float]], resource_column='rss', first_allocation_column='first_allocation', run_time_column='run_time',
+					workers: int = 1, shard_size: int = SHARD_SIZE, processes: bool = False, mask: bool = False) -> Wastage:
+	"""
+	Parallel evaluation mode for the wastage functions.
+	The jobs are split into shards of `shard_size` consecutive jobs. Each worker reduces a contiguous block of shards to per-shard partial sums,
+	reusing one set of preallocated scratch buffers for all of its shards. The partial sums are merged with math.fsum, which is exactly rounded.
+	Because the shard boundaries do not depend on the number of workers, the result is bit-for-bit identical for any number of workers.
+	It can differ in the last digits from the non-sharded evaluation, which sums all jobs at once.
+	:param df: data frame containing the actual resource usage, first allocation, and execution duration of the jobs
+	:param kernel: reduces one shard, e.g., partial(_exponential_kernel, relative_ttf=0.5, base=2). Called with the shard's resource usage, first allocation, and run time, and an array of four scratch buffers.
+	:param resource_column: the name of the column to read the actual resource usage from
+	:param first_allocation_column: column that contains the first allocation
+	:param run_time_column: column that contains the execution duration
+	:param workers: number of threads (or processes) to use
+	:param shard_size: number of jobs per shard
+	:param processes: use a process pool instead of a thread pool. The kernel must be picklable.
+	:param mask: also preallocate a boolean scratch buffer and pass it to the kernel as keyword argument `mask`
+	:return:
+	"""
+	assert len(df) > 0
+	assert workers >= 1, "workers = {}, must be >= 1".format(workers)
+	assert shard_size >= 1, "shard_size = {}, must be >= 1".format(shard_size)
+
+	rss = np.ascontiguousarray(df[resource_column], dtype=float)
+	first_allocation = np.ascontiguousarray(df[first_allocation_column], dtype=float)
+	run_time = np.ascontiguousarray(df[run_time_column], dtype=float)
+
+	# assign each worker a contiguous block of whole shards
+	shards = math.ceil(len(rss) / shard_size)
+	block = math.ceil(shards / workers) * shard_size
+	blocks = [(start, min(start + block, len(rss))) for start in range(0, len(rss), block)]
+
+	if len(blocks) == 1:
+		partials = _reduce_shards(kernel, rss, first_allocation, run_time, shard_size, mask)
+	else:
+		pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+		with pool(max_workers=workers) as executor:
+			futures = [executor.submit(_reduce_shards, kernel, rss[start:stop], first_allocation[start:stop], run_time[start:stop], shard_size, mask) for start, stop in blocks]
+			partials = [partial_sums for future in futures for partial_sums in future.result()]
+
+	oversizing, undersizing, usage, failures = (math.fsum(column) for column in zip(*partials))
+
+	return Wastage(oversizing=oversizing, undersizing=undersizing, usage=usage, failures=int(failures))
+
+
+def _reduce_shards(kernel, rss: np.ndarray, first_allocation: np.ndarray, run_time: np.ndarray, shard_size: int, mask: bool) -> [Tuple[float, float, float, float]]:
+	"""
+	Apply the kernel to consecutive shards of the given arrays.
+	:return: the oversizing, undersizing, usage, and failures of each shard
+	"""
+	buffers = np.empty((4, shard_size))
+	mask_buffer = np.empty(shard_size, dtype=bool) if mask else None
+
+	partials = []
+	for start in range(0, len(rss), shard_size):
+		stop = min(start + shard_size, len(rss))
+		n = stop - start
+		if mask:
+			partials.append(kernel(rss[start:stop], first_allocation[start:stop], run_time[start:stop], buffers[:, :n], mask=mask_buffer[:n]))
+		else:
+			partials.append(kernel(rss[start:stop], first_allocation[start:stop], run_time[start:stop], buffers[:, :n]))
+
+	return partials
+
+
+def _exponential_oversizing(rss: np.ndarray, first_allocation: np.ndarray, run_time: np.ndarray, k: np.ndarray, power: np.ndarray, tmp: np.ndarray, base: float) -> float:
+	"""
+	Shared part of the exponential kernels. Fills k with the number of failed attempts and power with base^k.
+	:return: the oversizing wastage of the shard
+	"""
+	np.divide(rss, first_allocation, out=k)
+	np.log(k, out=k)
+	np.divide(k, np.log(base), out=k)
+	np.ceil(k, out=k)
+	np.maximum(k, 0, out=k)
+	np.power(base, k, out=power)
+
+	np.multiply(first_allocation, power, out=tmp)
+	np.subtract(tmp, rss, out=tmp)
+	np.multiply(tmp, run_time, out=tmp)
+
+	return tmp.sum()
+
+
+def _exponential_kernel(rss: np.ndarray, first_allocation: np.ndarray, run_time: np.ndarray, buffers: np.ndarray, relative_ttf: float, base: float) -> Tuple[float, float, float, float]:
+	"""
+	Same computation as wastage_exponential for a single shard, using the scratch buffers instead of temporaries.
+	"""
+	k, power, tmp, _ = buffers
+	oversizing = _exponential_oversizing(rss, first_allocation, run_time, k, power, tmp, base)
+
+	np.subtract(power, 1, out=tmp)
+	np.multiply(first_allocation, tmp, out=tmp)
+	np.divide(tmp, base - 1, out=tmp)
+	np.multiply(tmp, run_time, out=tmp)
+	np.multiply(tmp, relative_ttf, out=tmp)
+	undersizing = tmp.sum()
+
+	np.multiply(run_time, rss, out=tmp)
+	usage = tmp.sum()
+
+	return oversizing, undersizing, usage, k.sum()
+
+
+def _exponential_prop_ttf_kernel(rss: np.ndarray, first_allocation: np.ndarray, run_time: np.ndarray, buffers: np.ndarray, base: float) -> Tuple[float, float, float, float]:
+	"""
+	Same computation as wastage_exponential_prop_ttf for a single shard, using the scratch buffers instead of temporaries.
+	"""
+	k, power, tmp, _ = buffers
+	oversizing = _exponential_oversizing(rss, first_allocation, run_time, k, power, tmp, base)
+
+	np.multiply(k, 2, out=power)
+	np.power(base, power, out=power)
+	np.subtract(power, 1, out=power)
+	np.power(first_allocation, 2, out=tmp)
+	np.divide(tmp, rss, out=tmp)
+	np.multiply(tmp, power, out=tmp)
+	np.divide(tmp, base ** 2 - 1, out=tmp)
+	np.multiply(tmp, run_time, out=tmp)
+	undersizing = tmp.sum()
+
+	np.multiply(run_time, rss, out=tmp)
+	usage = tmp.sum()
+
+	return oversizing, undersizing, usage, k.sum()
+
+
+def _3step_kernel(rss: np.ndarray, first_allocation: np.ndarray, run_time: np.ndarray, buffers: np.ndarray, mask: np.ndarray, max_seen_so_far: float, max_available: float, relative_ttf: float, eps: float) -> Tuple[float, float, float, float]:
+	"""
+	Same computation as wastage_3step for a single shard, using the scratch buffers instead of temporaries.
+	The attempts are checked from last to first, such that an earlier successful attempt overwrites a later one.
+	Jobs that do not succeed on any attempt produce NaN, as in wastage_3step.
+	"""
+	allocation, failures, previous_allocations, tmp = buffers
+
+	allocation.fill(np.nan)
+	failures.fill(np.nan)
+	previous_allocations.fill(np.nan)
+
+	np.less_equal(rss, max_available + eps, out=mask)
+	np.copyto(allocation, max_available, where=mask)
+	np.copyto(failures, 2, where=mask)
+	np.add(first_allocation, max_seen_so_far, out=previous_allocations, where=mask)
+
+	np.less_equal(rss, max_seen_so_far + eps, out=mask)
+	np.copyto(allocation, max_seen_so_far, where=mask)
+	np.copyto(failures, 1, where=mask)
+	np.copyto(previous_allocations, first_allocation, where=mask)
+
+	np.add(first_allocation, eps, out=tmp)
+	np.less_equal(rss, tmp, out=mask)
+	np.copyto(allocation, first_allocation, where=mask)
+	np.copyto(failures, 0, where=mask)
+	np.copyto(previous_allocations, 0, where=mask)
+
+	np.subtract(allocation, rss, out=tmp)
+	np.multiply(tmp, run_time, out=tmp)
+	oversizing = tmp.sum()
+
+	np.multiply(previous_allocations, run_time, out=tmp)
+	np.multiply(tmp, relative_ttf, out=tmp)
+	undersizing = tmp.sum()
+
+	np.multiply(run_time, rss, out=tmp)
+	usage = tmp.sum()
+
+	return oversizing, undersizing, usage, failures.sum()